@@ -1,13 +1,18 @@
-import streamlit as st, ee, folium, json, os
+import streamlit as st, ee, folium, os, sys, time
 from streamlit_folium import st_folium
-import pandas as pd, pyarrow as pa, pyarrow.parquet as pq
+import numpy as np, pyarrow as pa, pyarrow.parquet as pq
 
-# init EE
-try:
-    ee.Initialize(project="original-dahlia-471603-f2")
-except:
-    ee.Authenticate()
-    ee.Initialize(project="original-dahlia-471603-f2")
+# init EE (high-volume endpoint: many small concurrent requests)
+def _init_ee():
+    opts = dict(project="original-dahlia-471603-f2",
+                opt_url="https://earthengine-highvolume.googleapis.com")
+    try:
+        ee.Initialize(**opts)
+    except:
+        ee.Authenticate()
+        ee.Initialize(**opts)
+
+_init_ee()
 
 st.set_page_config(layout="wide")
 st.title("🌍 AlphaEarth Explorer (Esri Stallie)")
@@ -19,18 +24,63 @@ YEAR = st.sidebar.slider("Year", 2018, 2023, 2021)
 
 # files
 os.makedirs("labels", exist_ok=True)
-PARQUET_PATH = "labels/alphaearth_clicks.parquet"
-JSON_PATH = "labels/alphaearth_clicks.json"
+PARQUET_PATH = "labels/alphaearth_clicks"  # dataset dir, one part file per save
+LEGACY_PARQUET_PATH = "labels/alphaearth_clicks.parquet"  # pre-dataset single file
+SCHEMA = pa.schema([
+    ("lon", pa.float64()), ("lat", pa.float64()), ("caption", pa.string()),
+    ("alphaearth", pa.list_(pa.float32(), 64)),
+    ("thumb_m", pa.int64()), ("sample_scale", pa.int64()),
+])
+SUMMARY_COLS = ["lon", "lat", "caption", "thumb_m", "sample_scale"]
+# zstd for the scalar columns; the embedding is high-entropy, so skip compressing it
+ZSTD_COLS = [c for c in SCHEMA.names if c != "alphaearth"]
+COMPRESSION = {**{c: "zstd" for c in ZSTD_COLS}, "alphaearth": "none"}
+COMPRESSION_LEVEL = {c: 3 for c in ZSTD_COLS}
+
+def has_parquet(path):
+    return os.path.isdir(path) and any(f.endswith(".parquet") for f in os.listdir(path))
+
+def save_parquet(tbl, path):
+    """Append a batch as its own part file; written under a temp name, then renamed."""
+    os.makedirs(path, exist_ok=True)
+    final = os.path.join(path, f"part-{time.time_ns()}.parquet")
+    pq.write_table(tbl, final + ".tmp",
+                   compression=COMPRESSION, compression_level=COMPRESSION_LEVEL)
+    os.replace(final + ".tmp", final)
+
+# one-time import of the old single-file dataset as the first part file
+if (os.path.isfile(LEGACY_PARQUET_PATH) and os.path.getsize(LEGACY_PARQUET_PATH) > 0
+        and not has_parquet(PARQUET_PATH)):
+    try:
+        legacy = pq.read_table(LEGACY_PARQUET_PATH).select(SCHEMA.names).cast(SCHEMA)
+    except Exception as e:
+        legacy = None
+        st.warning(f"Skipped importing legacy labels from {LEGACY_PARQUET_PATH}: {e}")
+    if legacy is not None:
+        save_parquet(legacy, PARQUET_PATH)
 
-records = []
-if os.path.exists(JSON_PATH):
-    try: records = json.load(open(JSON_PATH))
-    except: pass
+@st.cache_data(show_spinner=False)
+def load_tail(path, mtime, n=10):
+    """Last `n` rows of the scalar columns, read newest row group first; mtime keys the cache."""
+    chunks, have = [], 0
+    parts = sorted(f for f in os.listdir(path) if f.endswith(".parquet"))
+    for name in reversed(parts):
+        pf = pq.ParquetFile(os.path.join(path, name))
+        for i in reversed(range(pf.num_row_groups)):
+            if have >= n:
+                break
+            chunks.append(pf.read_row_group(i, columns=SUMMARY_COLS))
+            have += chunks[-1].num_rows
+        if have >= n:
+            break
+    if not chunks:
+        return SCHEMA.empty_table().select(SUMMARY_COLS).to_pandas()
+    return pa.concat_tables(chunks[::-1]).to_pandas().tail(n)
 
 alpha_img = (ee.ImageCollection("GOOGLE/SATELLITE_EMBEDDING/V1/ANNUAL")
              .filterDate(f"{YEAR}-01-01", f"{YEAR+1}-01-01")
              .mosaic().select(["A.*"]))
-band_names = [f"A{i:02d}" for i in range(64)]
+band_names = tuple(sys.intern(f"A{i:02d}") for i in range(64))
 
 # --- interactive Google map ---
 m = folium.Map(
@@ -53,23 +103,27 @@ if output and output.get("last_clicked"):
     if st.button("💾 Save Sample"):
         pt = ee.Geometry.Point([lon, lat])
         square = pt.buffer(THUMB_METERS).bounds()
-        samples = alpha_img.sample(region=square, scale=SAMPLE_SCALE, geometries=True)
-        feats = samples.getInfo()["features"]
-        for f in feats:
-            vals = [f["properties"].get(b) for b in band_names]
-            records.append({
-                "lon": f["geometry"]["coordinates"][0],
-                "lat": f["geometry"]["coordinates"][1],
-                "caption": caption.strip(),
-                "alphaearth": vals,
-                "thumb_m": THUMB_METERS,
-                "sample_scale": SAMPLE_SCALE
-            })
-        json.dump(records, open(JSON_PATH, "w"), indent=2)
-        pq.write_table(pa.Table.from_pandas(pd.DataFrame(records)), PARQUET_PATH)
-        st.success(f"✅ Saved {len(feats)} AlphaEarth vectors for '{caption}'")
+        # pivot server-side: one [lon, lat, A00..A63] row per pixel, no per-band dicts
+        cols = ["longitude", "latitude", *band_names]
+        samples = (alpha_img.addBands(ee.Image.pixelLonLat())
+                   .sample(region=square, scale=SAMPLE_SCALE))
+        rows = samples.reduceColumns(ee.Reducer.toList(len(cols)), cols).get("list").getInfo()
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, len(cols))
+        lons, lats = rows[:, 0], rows[:, 1]
+        emb = rows[:, 2:].astype(np.float32)
+        n = len(emb)
+        if n == 0:
+            st.warning("No AlphaEarth pixels at this location; nothing saved.")
+        else:
+            tbl = pa.Table.from_pydict({
+                "lon": lons, "lat": lats, "caption": [caption.strip()] * n,
+                "alphaearth": pa.FixedSizeListArray.from_arrays(emb.ravel(), 64),
+                "thumb_m": [THUMB_METERS] * n, "sample_scale": [SAMPLE_SCALE] * n,
+            }, schema=SCHEMA)
+            save_parquet(tbl, PARQUET_PATH)
+            st.success(f"✅ Saved {n} AlphaEarth vectors for '{caption}'")
 
-if os.path.exists(PARQUET_PATH):
-    df = pq.read_table(PARQUET_PATH).to_pandas()
+if has_parquet(PARQUET_PATH):
+    df = load_tail(PARQUET_PATH, os.path.getmtime(PARQUET_PATH))
     st.markdown("### 📊 Dataset Summary")
     st.write(df.tail(10))
@@ -1,9 +1,12 @@
 import streamlit as st
-import ee, json, os, random, time, requests
-import pandas as pd
+import ee, os, random, sys, time, requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import folium
 from io import BytesIO
 from PIL import Image as PILImage
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from streamlit_folium import st_folium
 import pyarrow as pa
 import pyarrow.parquet as pq
@@ -11,11 +14,18 @@ import pyarrow.parquet as pq
 # -------------------------------
 # Earth Engine init
 # -------------------------------
-try:
-    ee.Initialize(project="original-dahlia-471603-f2")
-except Exception:
-    ee.Authenticate()
-    ee.Initialize(project="original-dahlia-471603-f2")
+EE_PROJECT = "original-dahlia-471603-f2"
+EE_HV_URL = "https://earthengine-highvolume.googleapis.com"
+
+def _init_ee():
+    """Initialize EE against the high-volume endpoint (tuned for many small requests)."""
+    try:
+        ee.Initialize(project=EE_PROJECT, opt_url=EE_HV_URL)
+    except Exception:
+        ee.Authenticate()
+        ee.Initialize(project=EE_PROJECT, opt_url=EE_HV_URL)
+
+_init_ee()
 
 # -------------------------------
 # UI setup
@@ -45,20 +55,59 @@ st.sidebar.markdown(f"**Est. AlphaEarth vectors per caption:** {est_embeddings:,
 # Data paths
 # -------------------------------
 os.makedirs("labels", exist_ok=True)
-JSON_PATH = "labels/alphaearth_captions.json"
-PARQUET_PATH = "labels/alphaearth_dataset.parquet"
+# Parquet dataset directory: one part file per saved batch
+PARQUET_PATH = "labels/alphaearth_dataset"
+LEGACY_PARQUET_PATH = "labels/alphaearth_dataset.parquet"  # pre-dataset single file
+SCHEMA = pa.schema([
+    ("lon", pa.float64()),
+    ("lat", pa.float64()),
+    ("caption", pa.string()),
+    ("thumb_m", pa.int64()),
+    ("sample_scale", pa.int64()),
+    ("alphaearth", pa.list_(pa.float32(), 64)),
+])
+# zstd for the scalar columns; the embedding is high-entropy, so skip compressing it
+ZSTD_COLS = [c for c in SCHEMA.names if c != "alphaearth"]
+COMPRESSION = {**{c: "zstd" for c in ZSTD_COLS}, "alphaearth": "none"}
+COMPRESSION_LEVEL = {c: 3 for c in ZSTD_COLS}
 
-records = []
-if os.path.exists(JSON_PATH):
-    try:
-        records = json.load(open(JSON_PATH))
-    except Exception:
-        pass
+def has_parquet(path):
+    return os.path.isdir(path) and any(f.endswith(".parquet") for f in os.listdir(path))
 
-if os.path.exists(PARQUET_PATH) and os.path.getsize(PARQUET_PATH) > 0:
-    df = pq.read_table(PARQUET_PATH).to_pandas()
-else:
-    df = pd.DataFrame(columns=["lon", "lat", "caption", "thumb_m", "sample_scale"])
+SUMMARY_COLS = ["lon", "lat", "caption", "thumb_m", "sample_scale"]
+
+@st.cache_data(show_spinner=False)
+def load_tail(path, mtime, n=200):
+    """Last `n` rows (scalar columns only) and the total row count; `mtime` keys the cache.
+
+    Row groups are read newest-first and data reads stop once `n` rows are in hand.
+    The total still opens every part's footer, so a cache miss is O(number of saves).
+    """
+    parts = sorted(f for f in os.listdir(path) if f.endswith(".parquet"))
+    chunks, have, total = [], 0, 0
+    for name in reversed(parts):
+        pf = pq.ParquetFile(os.path.join(path, name))
+        total += pf.metadata.num_rows
+        for i in reversed(range(pf.num_row_groups)):
+            if have >= n:
+                break
+            rg = pf.read_row_group(i, columns=SUMMARY_COLS)
+            chunks.append(rg)
+            have += rg.num_rows
+    if not chunks:
+        return SCHEMA.empty_table().select(SUMMARY_COLS).to_pandas(), total
+    tail = pa.concat_tables(chunks[::-1]).to_pandas()
+    return tail.tail(n).reset_index(drop=True), total
+
+@st.cache_resource(max_entries=4)
+def build_summary_map(points):
+    """Map of recent samples; `points` is a hashable tuple of (lat, lon, caption)."""
+    m = folium.Map(location=[39, -98], zoom_start=4)
+    for lat_i, lon_i, cap in points:
+        folium.CircleMarker(
+            [lat_i, lon_i], radius=4, color="#2b8a3e",
+            fill=True, fill_opacity=0.8, popup=cap).add_to(m)
+    return m
 
 # -------------------------------
 # Imagery setup (Sentinel-2 SR)
@@ -80,37 +129,102 @@ s2 = (ee.ImageCollection("COPERNICUS/S2_SR_HARMONIZED")
       .filter(ee.Filter.lt("CLOUDY_PIXEL_PERCENTAGE", 70)))
 
 def mask_clouds(img):
-    scl = img.select("SCL")
-    mask = scl.neq(3).And(scl.neq(8)).And(scl.neq(9)).And(scl.neq(10))
-    return img.updateMask(mask)
+    # SCL 3/8/9/10 = cloud shadow, cloud (med/high prob), cirrus
+    mask = img.select("SCL").remap([3, 8, 9, 10], [0, 0, 0, 0], 1)
+    return img.select(["B4","B3","B2"]).updateMask(mask)
 
-s2_rgb = s2.map(mask_clouds).median().select(["B4","B3","B2"])
-band_names = [f"A{i:02d}" for i in range(64)]
+# only RGB + SCL are ever loaded; the other S2 bands never enter the graph
+s2_rgb = s2.select(["B4","B3","B2","SCL"]).map(mask_clouds).median()
+band_names = tuple(sys.intern(f"A{i:02d}") for i in range(64))
 
 # -------------------------------
 # Helpers
 # -------------------------------
-def save_parquet(records, path):
-    df_new = pd.DataFrame([
-        {"lon":r["lon"], "lat":r["lat"], "caption":r["caption"],
-         "thumb_m":r["thumb_m"], "sample_scale":r["sample_scale"],
-         "alphaearth":r["alphaearth"]}
-        for r in records
-    ])
-    pq.write_table(pa.Table.from_pandas(df_new, preserve_index=False), path)
+# pooled HTTP session, kept across reruns so TLS connections get reused
+if "http" not in st.session_state:
+    st.session_state.http = requests.Session()
+    st.session_state.http.mount("https://", HTTPAdapter(
+        pool_connections=8, pool_maxsize=8, max_retries=Retry(total=0)))
+_SESSION = st.session_state.http
+
+def make_table(lons, lats, emb, caption):
+    """Build a batch table; emb is an (N, 64) float32 array stored as a fixed-size list."""
+    n = len(emb)
+    return pa.Table.from_pydict({
+        "lon": lons, "lat": lats, "caption": [caption] * n,
+        "thumb_m": [THUMB_METERS] * n, "sample_scale": [SAMPLE_SCALE] * n,
+        "alphaearth": pa.FixedSizeListArray.from_arrays(emb.ravel(), 64),
+    }, schema=SCHEMA)
+
+def save_parquet(tbl, path):
+    """Append a batch to the dataset as its own part file (no rewrite of older rows)."""
+    os.makedirs(path, exist_ok=True)
+    final = os.path.join(path, f"part-{time.time_ns()}.parquet")
+    # write under a temp name so readers never see a part without its footer
+    pq.write_table(tbl, final + ".tmp",
+                   compression=COMPRESSION, compression_level=COMPRESSION_LEVEL)
+    os.replace(final + ".tmp", final)
+
+def migrate_legacy_parquet(legacy, path):
+    """One-time import of the old single-file dataset as the first part file."""
+    if not os.path.isfile(legacy) or os.path.getsize(legacy) == 0 or has_parquet(path):
+        return
+    try:
+        tbl = pq.read_table(legacy).select(SCHEMA.names).cast(SCHEMA)
+    except Exception as e:
+        st.warning(f"Skipped importing legacy labels from {legacy}: {e}")
+        return
+    save_parquet(tbl, path)
+
+migrate_legacy_parquet(LEGACY_PARQUET_PATH, PARQUET_PATH)
+
+def _probe_point(seed):
+    """Probe one random point; returns (pt, lon, lat, square) or None if no coverage."""
+    pt = ee.FeatureCollection.randomPoints(roi, 1, seed).first().geometry()
+    square = pt.buffer(THUMB_METERS).bounds()
+    # coords + coverage check in a single round-trip
+    info = ee.Dictionary({
+        "lon": pt.coordinates().get(0),
+        "lat": pt.coordinates().get(1),
+        "val": s2_rgb.reduceRegion(ee.Reducer.mean(), square, 120).get("B4"),
+    }).getInfo()
+    if info.get("val") is not None:
+        return pt, info["lon"], info["lat"], square
+    return None
 
 def get_random_valid_point(max_tries=6):
-    """Find random point with valid Sentinel coverage."""
-    for _ in range(max_tries):
-        seed = random.randint(0, 999999)
-        pt = ee.FeatureCollection.randomPoints(roi, 1, seed).first().geometry()
-        lon, lat = pt.coordinates().getInfo()
-        square = pt.buffer(THUMB_METERS).bounds()
-        val = s2_rgb.reduceRegion(ee.Reducer.mean(), square, 120).get("B4").getInfo()
-        if val is not None:
-            return pt, lon, lat, square
+    """Find random point with valid Sentinel coverage (probes run concurrently)."""
+    pool = ThreadPoolExecutor(max_workers=max_tries)
+    futures = [pool.submit(_probe_point, random.randint(0, 999999))
+               for _ in range(max_tries)]
+    last_exc, any_empty = None, False
+    try:
+        for fut in as_completed(futures):
+            try:
+                result = fut.result()
+            except Exception as e:
+                last_exc = e
+                continue
+            if result is not None:
+                return result
+            any_empty = True
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    # every probe errored (auth, quota, ...): surface it rather than "no imagery"
+    if not any_empty and last_exc is not None:
+        raise last_exc
     return None, None, None, None
 
+def fetch_embeddings(square, max_pixels=100):
+    """Sample AlphaEarth pixels over `square` server-side; returns (lons, lats, emb)."""
+    # pivot server-side: one [lon, lat, A00..A63] row per sampled pixel, no per-band dicts
+    cols = ["longitude", "latitude", *band_names]
+    samples = (alpha_img.addBands(ee.Image.pixelLonLat())
+               .sample(region=square, scale=SAMPLE_SCALE, numPixels=max_pixels))
+    rows = samples.reduceColumns(ee.Reducer.toList(len(cols)), cols).get("list").getInfo()
+    rows = np.asarray(rows, dtype=np.float64).reshape(-1, len(cols))
+    return rows[:, 0], rows[:, 1], rows[:, 2:].astype(np.float32)
+
 def fetch_valid_thumbnail(square, tries=4, timeout=8):
     """Fetch thumbnail and ensure it actually loads."""
     for _ in range(tries):
@@ -121,14 +235,52 @@ def fetch_valid_thumbnail(square, tries=4, timeout=8):
                 "format": "png",
                 "min": 0, "max": 3000
             })
-            r = requests.get(url, timeout=timeout)
+            r = _SESSION.get(url, timeout=timeout)
             if r.status_code == 200 and len(r.content) > 10000:
                 img = PILImage.open(BytesIO(r.content))
+                img.load()
                 return url, img
         except Exception:
             time.sleep(0.5)
     return None, None
 
+# single background worker that fetches the next point + thumbnail while the user captions
+if "prefetch_pool" not in st.session_state:
+    st.session_state.prefetch_pool = ThreadPoolExecutor(max_workers=1)
+
+def _sample_key():
+    return (STATE, THUMB_METERS, YEAR, THUMB_PIXELS)
+
+def _fetch_next():
+    """Probe a point and download its thumbnail (runs on the prefetch worker)."""
+    current = get_random_valid_point()
+    thumb = fetch_valid_thumbnail(current[3]) if current[0] is not None else (None, None)
+    return current, thumb
+
+def prefetch_next():
+    """Start fetching the next sample in the background (at most one in flight)."""
+    if "next_future" in st.session_state and st.session_state.next_key == _sample_key():
+        return
+    stale = st.session_state.get("next_future")
+    if stale is not None:
+        stale.cancel()  # don't let jobs for old settings queue ahead of the new one
+    st.session_state.next_key = _sample_key()
+    st.session_state.next_future = st.session_state.prefetch_pool.submit(_fetch_next)
+
+def advance():
+    """Move to the next sample, taking the prefetched one if it matches the sidebar settings."""
+    fut = st.session_state.pop("next_future", None)
+    key = st.session_state.pop("next_key", None)
+    if fut is not None and key == _sample_key():
+        try:
+            st.session_state.current, thumb = fut.result()
+            st.session_state.thumb = (key, *thumb)
+            return
+        except Exception:
+            pass
+    st.session_state.current = get_random_valid_point()
+    st.session_state.pop("thumb", None)
+
 # -------------------------------
 # Landing page
 # -------------------------------
@@ -137,7 +289,7 @@ if "initialized" not in st.session_state:
     st.write("Click **Start Sampling** to fetch your first Sentinel-2 image.")
     if st.button("🚀 Start Sampling"):
         st.session_state.initialized = True
-        st.session_state.current = get_random_valid_point()
+        advance()
         st.rerun()
     st.stop()
 
@@ -145,24 +297,30 @@ if "initialized" not in st.session_state:
 # Session sampling loop
 # -------------------------------
 if "current" not in st.session_state:
-    st.session_state.current = get_random_valid_point()
+    advance()
 
 pt, lon, lat, square = st.session_state.current
 if pt is None:
     st.error("Could not find visible imagery; try smaller thumbnail or larger scale.")
     st.stop()
 
-with st.spinner("⏳ Fetching Sentinel-2 thumbnail..."):
-    url, img = fetch_valid_thumbnail(square)
-    time.sleep(0.3)
+# the thumbnail is kept across reruns; only refetched when the sample or settings change
+thumb = st.session_state.get("thumb")
+if thumb is None or thumb[0] != _sample_key():
+    with st.spinner("⏳ Fetching Sentinel-2 thumbnail..."):
+        thumb = (_sample_key(), *fetch_valid_thumbnail(square))
+        time.sleep(0.3)
+    st.session_state.thumb = thumb
+_, url, img = thumb
 
 if img is None:
     st.warning("⚠️ Could not load image (likely rate-limited). Retrying automatically...")
-    st.session_state.current = get_random_valid_point()
+    advance()
     st.rerun()
 
 st.success("✅ Image fetched successfully!")
 st.image(img, caption=f"{STATE} — ({lat:.3f}, {lon:.3f})")
+prefetch_next()
 
 # -------------------------------
 # Caption + buttons
@@ -173,45 +331,31 @@ save_btn = col1.button("💾 Submit & Next")
 skip_btn = col2.button("⏭️ Skip / Random New")
 
 if skip_btn:
-    st.session_state.current = get_random_valid_point()
+    advance()
     st.rerun()
 
 if save_btn:
     if caption.strip():
-        samples = alpha_img.sample(region=square, scale=SAMPLE_SCALE,
-                                   numPixels=100, geometries=True)
-        feats = samples.getInfo()["features"]
-        for f in feats:
-            vals = [f["properties"].get(b) for b in band_names]
-            records.append({
-                "lon": f["geometry"]["coordinates"][0],
-                "lat": f["geometry"]["coordinates"][1],
-                "caption": caption.strip(),
-                "alphaearth": vals,
-                "thumb_m": THUMB_METERS,
-                "sample_scale": SAMPLE_SCALE
-            })
-        json.dump(records, open(JSON_PATH, "w"), indent=2)
-        save_parquet(records, PARQUET_PATH)
-        st.success(f"✅ Saved {len(feats)} AlphaEarth vectors for '{caption}'")
-        st.session_state.current = get_random_valid_point()
-        st.rerun()
+        lons, lats, emb = fetch_embeddings(square)
+        if len(emb) == 0:
+            st.warning("No AlphaEarth pixels in this region; nothing saved.")
+        else:
+            save_parquet(make_table(lons, lats, emb, caption.strip()), PARQUET_PATH)
+            st.success(f"✅ Saved {len(emb)} AlphaEarth vectors for '{caption}'")
+            advance()
+            st.rerun()
     else:
         st.warning("Enter a caption before submitting.")
 
 # -------------------------------
 # Dataset summary
 # -------------------------------
-if os.path.exists(PARQUET_PATH) and os.path.getsize(PARQUET_PATH) > 0:
-    df = pq.read_table(PARQUET_PATH).to_pandas()
-    summary_df = df.drop(columns=["alphaearth"])
+if has_parquet(PARQUET_PATH):
+    summary_df, total = load_tail(PARQUET_PATH, os.path.getmtime(PARQUET_PATH))
     st.markdown("### 📊 Current Dataset Summary")
     st.dataframe(summary_df.tail(15), use_container_width=True)
-    st.write(f"Total labeled vectors: **{len(df)}**")
+    st.write(f"Total labeled vectors: **{total}**")
 
-    m = folium.Map(location=[39, -98], zoom_start=4)
-    for _, r in summary_df.tail(200).iterrows():
-        folium.CircleMarker(
-            [r["lat"], r["lon"]], radius=4, color="#2b8a3e",
-            fill=True, fill_opacity=0.8, popup=r["caption"]).add_to(m)
+    recent = summary_df.tail(200)[["lat", "lon", "caption"]]
+    m = build_summary_map(tuple(recent.itertuples(index=False, name=None)))
     st_folium(m, width=700, height=500)